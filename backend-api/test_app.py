@@ -1,167 +1,288 @@
-import pytest
+import os
+os.environ['DATABASE_URL'] = 'sqlite+aiosqlite:///:memory:'  # Must be set before importing app
+
+import contextlib
+import gzip
 import json
-from app import app as flask_app, db, User, Group # Import User and Group here
 
-@pytest.fixture
-def app(): # This fixture is correctly named 'app'
+import pytest
+import pytest_asyncio
+from sqlalchemy import event, select
+from sqlalchemy.orm import selectinload
+from app import app as quart_app, engine, invalidate_groups_cache, SessionLocal, Base, User, Group # Import User and Group here
+
+@pytest_asyncio.fixture
+async def app(): # This fixture is correctly named 'app'
     """Create and configure a new app instance for each test."""
-    flask_app.config.update({
+    quart_app.config.update({
         "TESTING": True,
-        "SQLALCHEMY_DATABASE_URI": "sqlite:///:memory:",
-        "SQLALCHEMY_TRACK_MODIFICATIONS": False,
+        "GROUPS_CACHE_ENABLED": False,  # Each test gets a fresh DB; don't serve stale lists
     })
 
-    with flask_app.app_context():
-        db.create_all()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
 
-    yield flask_app # Pytest uses the name of this function 'app' as the fixture name
+    yield quart_app # Pytest uses the name of this function 'app' as the fixture name
 
-    with flask_app.app_context():
-        db.session.remove()
-        db.drop_all()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
 
 @pytest.fixture
 def client(app): # Correct: The client fixture depends on the 'app' fixture
     """A test client for the app."""
     return app.test_client()
 
+async def get_user(name):
+    """Fetch a user by name directly from the DB."""
+    async with SessionLocal() as session:
+        result = await session.execute(select(User).where(User.name == name))
+        return result.scalar_one_or_none()
+
+async def get_group_with_members(group_id):
+    """Fetch a group (members eagerly loaded) directly from the DB."""
+    async with SessionLocal() as session:
+        result = await session.execute(
+            select(Group).options(selectinload(Group.members)).where(Group.id == group_id)
+        )
+        return result.scalar_one_or_none()
+
 # --- Test User Management ---
-def test_set_username_success(client, app): # Correct: Request 'app' fixture for app_context
-    response = client.post('/api/users', json={'name': 'Alice'})
+@pytest.mark.asyncio
+async def test_set_username_success(client):
+    response = await client.post('/api/users', json={'name': 'Alice'})
     assert response.status_code == 201
-    data = response.get_json()
+    data = await response.get_json()
     assert data['userId'] == 'Alice'
     assert data['name'] == 'Alice'
 
     # Verify in DB
-    with app.app_context(): # Correct: Use the 'app' fixture instance
-        user = User.query.filter_by(name='Alice').first()
-        assert user is not None
-        assert user.name == 'Alice'
-
-def test_set_existing_username(client, app): # Correct: Request 'app' fixture
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Alice'})
-    response = client.post('/api/users', json={'name': 'Alice'})
+    user = await get_user('Alice')
+    assert user is not None
+    assert user.name == 'Alice'
+
+@pytest.mark.asyncio
+async def test_set_existing_username(client):
+    await client.post('/api/users', json={'name': 'Alice'})
+    response = await client.post('/api/users', json={'name': 'Alice'})
     assert response.status_code == 200
-    data = response.get_json()
+    data = await response.get_json()
     assert data['userId'] == 'Alice'
     assert 'message' in data
     assert data['message'] == "User already exists"
 
-# Tests that don't need direct app_context can just use client
-def test_set_username_missing_name(client):
-    response = client.post('/api/users', json={})
+@pytest.mark.asyncio
+async def test_set_username_missing_name(client):
+    response = await client.post('/api/users', json={})
     assert response.status_code == 400
     # ... (rest of assertions)
 
-def test_set_username_empty_name(client):
-    response = client.post('/api/users', json={'name': '  '})
+@pytest.mark.asyncio
+async def test_set_username_empty_name(client):
+    response = await client.post('/api/users', json={'name': '  '})
     assert response.status_code == 400
     # ... (rest of assertions)
 
 
 # --- Test Group Management ---
-def test_create_group_success(client, app): # Correct: Request 'app' fixture
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Charlie'})
+@pytest.mark.asyncio
+async def test_create_group_success(client):
+    await client.post('/api/users', json={'name': 'Charlie'})
 
-    response = client.post('/api/groups', json={'groupName': 'Test Group', 'creatorName': 'Charlie'})
+    response = await client.post('/api/groups', json={'groupName': 'Test Group', 'creatorName': 'Charlie'})
     assert response.status_code == 201
-    data = response.get_json()
+    data = await response.get_json()
     group_id = data['groupId']
     # ... (rest of assertions for response data)
 
-    with app.app_context(): # Correct: Use the 'app' fixture instance
-        group = Group.query.get(group_id)
-        assert group is not None
-        # ... (rest of DB assertions)
-        charlie = User.query.filter_by(name='Charlie').first()
-        assert charlie in group.members
+    group = await get_group_with_members(group_id)
+    assert group is not None
+    # ... (rest of DB assertions)
+    member_names = [member.name for member in group.members]
+    assert 'Charlie' in member_names
 
 
-def test_create_group_missing_fields(client, app): # Correct
-    with app.app_context():
-        client.post('/api/users', json={'name': 'David'})
-    response = client.post('/api/groups', json={'creatorName': 'David'})
+@pytest.mark.asyncio
+async def test_create_group_missing_fields(client):
+    await client.post('/api/users', json={'name': 'David'})
+    response = await client.post('/api/groups', json={'creatorName': 'David'})
     assert response.status_code == 400
     # ...
 
-def test_create_group_empty_group_name(client, app): # Correct
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Eve'})
-    response = client.post('/api/groups', json={'groupName': ' ', 'creatorName': 'Eve'})
+@pytest.mark.asyncio
+async def test_create_group_empty_group_name(client):
+    await client.post('/api/users', json={'name': 'Eve'})
+    response = await client.post('/api/groups', json={'groupName': ' ', 'creatorName': 'Eve'})
     assert response.status_code == 400
     # ...
 
-def test_create_group_creator_not_found(client):
-    response = client.post('/api/groups', json={'groupName': 'New Group', 'creatorName': 'NonExistentUser'})
+@pytest.mark.asyncio
+async def test_create_group_creator_not_found(client):
+    response = await client.post('/api/groups', json={'groupName': 'New Group', 'creatorName': 'NonExistentUser'})
     assert response.status_code == 404
     # ...
 
-def test_get_groups_empty(client):
-    response = client.get('/api/groups')
+@pytest.mark.asyncio
+async def test_get_groups_empty(client):
+    response = await client.get('/api/groups')
     assert response.status_code == 200
-    assert response.get_json() == []
+    assert await response.get_json() == []
 
-def test_get_groups_with_data(client, app): # Correct
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Frank'})
-        client.post('/api/groups', json={'groupName': 'Group1', 'creatorName': 'Frank'})
-        client.post('/api/groups', json={'groupName': 'Group2', 'creatorName': 'Frank'})
+@pytest.mark.asyncio
+async def test_get_groups_with_data(client):
+    await client.post('/api/users', json={'name': 'Frank'})
+    await client.post('/api/groups', json={'groupName': 'Group1', 'creatorName': 'Frank'})
+    await client.post('/api/groups', json={'groupName': 'Group2', 'creatorName': 'Frank'})
 
-    response = client.get('/api/groups')
+    response = await client.get('/api/groups')
     assert response.status_code == 200
     # ...
 
-def test_join_group_success(client, app): # Correct
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Grace'})
-        client.post('/api/users', json={'name': 'Heidi'})
-        group_res = client.post('/api/groups', json={'groupName': 'Community', 'creatorName': 'Grace'})
-        group_id = group_res.get_json()['groupId']
+@pytest.mark.asyncio
+async def test_join_group_success(client):
+    await client.post('/api/users', json={'name': 'Grace'})
+    await client.post('/api/users', json={'name': 'Heidi'})
+    group_res = await client.post('/api/groups', json={'groupName': 'Community', 'creatorName': 'Grace'})
+    group_id = (await group_res.get_json())['groupId']
 
-    response = client.post(f'/api/groups/{group_id}/join', json={'userName': 'Heidi'})
+    response = await client.post(f'/api/groups/{group_id}/join', json={'userName': 'Heidi'})
     assert response.status_code == 200
     # ...
 
-    with app.app_context(): # Correct
-        group = Group.query.get(group_id)
-        assert group is not None
-        heidi = User.query.filter_by(name='Heidi').first()
-        assert heidi is not None
-        assert heidi in group.members
+    group = await get_group_with_members(group_id)
+    assert group is not None
+    member_names = [member.name for member in group.members]
+    assert 'Heidi' in member_names
 
-def test_join_group_already_member(client, app): # Correct
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Grace'})
-        group_res = client.post('/api/groups', json={'groupName': 'Community', 'creatorName': 'Grace'})
-        group_id = group_res.get_json()['groupId']
+@pytest.mark.asyncio
+async def test_join_group_already_member(client):
+    await client.post('/api/users', json={'name': 'Grace'})
+    group_res = await client.post('/api/groups', json={'groupName': 'Community', 'creatorName': 'Grace'})
+    group_id = (await group_res.get_json())['groupId']
 
-    response = client.post(f'/api/groups/{group_id}/join', json={'userName': 'Grace'})
+    response = await client.post(f'/api/groups/{group_id}/join', json={'userName': 'Grace'})
     assert response.status_code == 200
     # ...
 
-def test_join_group_group_not_found(client, app): # Correct
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Ivan'})
-    response = client.post('/api/groups/nonexistentgroup/join', json={'userName': 'Ivan'})
+@pytest.mark.asyncio
+async def test_join_group_group_not_found(client):
+    await client.post('/api/users', json={'name': 'Ivan'})
+    response = await client.post('/api/groups/nonexistentgroup/join', json={'userName': 'Ivan'})
     assert response.status_code == 404
 
-def test_join_group_user_not_found(client, app): # Correct
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Judy'})
-        group_res = client.post('/api/groups', json={'groupName': 'Inner Circle', 'creatorName': 'Judy'})
-        group_id = group_res.get_json()['groupId']
+@pytest.mark.asyncio
+async def test_join_group_user_not_found(client):
+    await client.post('/api/users', json={'name': 'Judy'})
+    group_res = await client.post('/api/groups', json={'groupName': 'Inner Circle', 'creatorName': 'Judy'})
+    group_id = (await group_res.get_json())['groupId']
 
-    response = client.post(f'/api/groups/{group_id}/join', json={'userName': 'Mallory'})
+    response = await client.post(f'/api/groups/{group_id}/join', json={'userName': 'Mallory'})
     assert response.status_code == 404
 
-def test_join_group_missing_username(client, app): # Correct
-    with app.app_context():
-        client.post('/api/users', json={'name': 'Oscar'})
-        group_res = client.post('/api/groups', json={'groupName': 'Study Group', 'creatorName': 'Oscar'})
-        group_id = group_res.get_json()['groupId']
+@pytest.mark.asyncio
+async def test_join_group_missing_username(client):
+    await client.post('/api/users', json={'name': 'Oscar'})
+    group_res = await client.post('/api/groups', json={'groupName': 'Study Group', 'creatorName': 'Oscar'})
+    group_id = (await group_res.get_json())['groupId']
+
+    response = await client.post(f'/api/groups/{group_id}/join', json={})
+    assert response.status_code == 400
+
+
+# --- Query-count guard ---
+@pytest.fixture
+def query_count():
+    """Context manager counting SQL statements executed while active.
+
+    Guards against reintroducing lazy-load N+1 patterns: a regression shows
+    up as a budget overrun instead of a silent slowdown.
+    """
+    counter = {'n': 0}
+
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counter['n'] += 1
+
+    @contextlib.contextmanager
+    def track():
+        counter['n'] = 0
+        event.listen(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
+        try:
+            yield counter
+        finally:
+            event.remove(engine.sync_engine, 'before_cursor_execute', _before_cursor_execute)
 
-    response = client.post(f'/api/groups/{group_id}/join', json={})
-    assert response.status_code == 400
\ No newline at end of file
+    return track
+
+@pytest.mark.asyncio
+async def test_get_group_members_query_budget(client, query_count):
+    await client.post('/api/users', json={'name': 'Peggy'})
+    await client.post('/api/users', json={'name': 'Rupert'})
+    group_res = await client.post('/api/groups', json={'groupName': 'Budgeted', 'creatorName': 'Peggy'})
+    group_id = (await group_res.get_json())['groupId']
+    await client.post(f'/api/groups/{group_id}/join', json={'userName': 'Rupert'})
+
+    with query_count() as counter:
+        response = await client.get(f'/api/groups/{group_id}/members')
+    assert response.status_code == 200
+    data = await response.get_json()
+    assert sorted(data['members']) == ['Peggy', 'Rupert']
+    # One query for the group, one batched IN for members — anything more
+    # means a lazy load crept back in
+    assert counter['n'] <= 3
+
+@pytest.mark.asyncio
+async def test_get_groups_query_budget(client, query_count):
+    await client.post('/api/users', json={'name': 'Sybil'})
+    await client.post('/api/groups', json={'groupName': 'G1', 'creatorName': 'Sybil'})
+    await client.post('/api/groups', json={'groupName': 'G2', 'creatorName': 'Sybil'})
+
+    with query_count() as counter:
+        response = await client.get('/api/groups')
+    assert response.status_code == 200
+    assert len(await response.get_json()) == 2
+    # Column projection: one SELECT total, no per-group member loads
+    assert counter['n'] <= 1
+
+
+@pytest.mark.asyncio
+async def test_groups_cache_serves_reads_and_invalidates(client, app, query_count):
+    app.config['GROUPS_CACHE_ENABLED'] = True
+    try:
+        await client.post('/api/users', json={'name': 'Trent'})
+        await client.post('/api/groups', json={'groupName': 'Cached', 'creatorName': 'Trent'})
+
+        first = await client.get('/api/groups')
+        with query_count() as counter:
+            second = await client.get('/api/groups')
+        # Second read is served from the cache without touching the DB
+        assert counter['n'] == 0
+        assert await second.get_json() == await first.get_json()
+
+        # A successful create invalidates the cached list
+        await client.post('/api/groups', json={'groupName': 'Fresh', 'creatorName': 'Trent'})
+        third = await client.get('/api/groups')
+        assert len(await third.get_json()) == 2
+    finally:
+        app.config['GROUPS_CACHE_ENABLED'] = False
+        invalidate_groups_cache()
+
+
+@pytest.mark.asyncio
+async def test_get_groups_cache_control_and_gzip(client):
+    await client.post('/api/users', json={'name': 'Victor'})
+    # Enough groups that the JSON body clears the compression threshold
+    for i in range(12):
+        await client.post('/api/groups', json={'groupName': f'Long-Winded Group Name {i}', 'creatorName': 'Victor'})
+
+    response = await client.get('/api/groups', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == 'private, max-age=5'
+    assert response.headers.get('Content-Encoding') == 'gzip'
+    body = json.loads(gzip.decompress(await response.get_data()))
+    assert len(body) == 12
+
+@pytest.mark.asyncio
+async def test_small_responses_not_compressed(client):
+    response = await client.get('/api/groups', headers={'Accept-Encoding': 'gzip'})
+    assert response.status_code == 200
+    assert 'Content-Encoding' not in response.headers
+    assert await response.get_json() == []
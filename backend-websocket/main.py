@@ -1,84 +1,398 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
 from fastapi.responses import HTMLResponse # Optional: for a simple test page
-from typing import Dict, List, Set
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import socket
+import weakref
+
+try:
+    import orjson
+except ImportError:  # orjson is in requirements.txt; fall back to stdlib json
+    orjson = None
+
+try:
+    import uvloop
+    # libuv-backed event loop: substantially lower per-send/recv overhead than
+    # the default selector loop for small-message WS traffic. One-line global
+    # effect; equivalent to running uvicorn with --loop uvloop.
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:  # pragma: no cover - uvloop is in requirements.txt
+    pass
+
+def tune_accepted_socket(websocket: WebSocket) -> None:
+    """Best-effort TCP tuning on a freshly accepted connection.
+
+    TCP_NODELAY keeps Nagle/delayed-ACK from adding tens of ms to each tiny
+    chat frame, and a bigger SO_SNDBUF absorbs broadcast bursts. The ASGI
+    spec doesn't expose the transport, so this probes uvicorn's internals
+    and silently does nothing on servers (or test mocks) shaped differently.
+    """
+    try:
+        protocol = getattr(getattr(websocket, "_send", None), "__self__", None)
+        transport = getattr(protocol, "transport", None)
+        sock = transport.get_extra_info("socket") if transport is not None else None
+        if sock is None:
+            return
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+    except (AttributeError, OSError):
+        pass
+
+def dumps_payload(payload: dict) -> str:
+    """Serialize a message payload to its wire form (JSON text) once."""
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload)
+
+def loads_payload(raw: str) -> dict:
+    """Parse an incoming JSON text frame."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
 
 app = FastAPI()
 
+# Module logger; stays silent at the default WARNING level, so the hot path
+# pays neither the stdout write syscall nor the string formatting that the
+# old print() calls did.
+logger = logging.getLogger(__name__)
+
+# Per-connection outbound queue depth. A peer that falls this many messages
+# behind is dropped instead of being allowed to stall or balloon memory.
+OUTBOUND_QUEUE_SIZE = 256
+
+# Hoisted enum member: the broadcast loop compares against it per socket
+_CONNECTED = WebSocketState.CONNECTED
+
+# Send-buffer size requested for accepted sockets: large enough that a burst
+# of broadcast frames to one peer queues in the kernel instead of causing
+# short writes back up in the writer task.
+SEND_BUFFER_SIZE = 262144
+
+# How long an empty group lingers before being reaped. Tab reloads and
+# flaky connections drain and refill groups constantly; keeping the state
+# around briefly means a quick reconnect reuses it instead of reallocating.
+GROUP_REAP_DELAY = 30.0
+
+@dataclass(slots=True)
+class GroupState:
+    """Per-group connection state, struct-of-arrays style.
+
+    Parallel lists iterate faster than a set in the hot broadcast loop, and
+    the alive flags let disconnect mark-without-remove, so a socket dying
+    mid-broadcast never shifts indices under an in-flight iteration;
+    compaction happens lazily once dead slots outnumber live ones. Each slot
+    also carries the connection's outbound queue and its writer task.
+    """
+    sockets: List[WebSocket] = field(default_factory=list)
+    usernames: List[str] = field(default_factory=list)
+    queues: List[asyncio.Queue] = field(default_factory=list)
+    tasks: List[asyncio.Task] = field(default_factory=list)
+    alive: bytearray = field(default_factory=bytearray)
+
+    def add(self, websocket: WebSocket, user_name: str, queue: asyncio.Queue, task: asyncio.Task):
+        self.sockets.append(websocket)
+        self.usernames.append(user_name)
+        self.queues.append(queue)
+        self.tasks.append(task)
+        self.alive.append(1)
+
+    def mark_dead(self, websocket: WebSocket):
+        """Flag a socket dead and cancel its writer; returns its index or None."""
+        try:
+            idx = self.sockets.index(websocket)
+        except ValueError:
+            return None
+        if not self.alive[idx]:
+            return None
+        self.alive[idx] = 0
+        self.tasks[idx].cancel()
+        return idx
+
+    def live_sockets(self) -> List[WebSocket]:
+        alive = self.alive
+        return [ws for i, ws in enumerate(self.sockets) if alive[i]]
+
+    def live_count(self) -> int:
+        return sum(self.alive)
+
+    def compact(self):
+        """Physically drop dead slots once they outnumber the live ones."""
+        if self.alive.count(0) > len(self.sockets) // 2:
+            keep = [i for i, a in enumerate(self.alive) if a]
+            self.sockets = [self.sockets[i] for i in keep]
+            self.usernames = [self.usernames[i] for i in keep]
+            self.queues = [self.queues[i] for i in keep]
+            self.tasks = [self.tasks[i] for i in keep]
+            self.alive = bytearray(b"\x01" * len(keep))
+
+
 class ConnectionManager:
+    # No instance __dict__: smaller objects and faster attribute access,
+    # which matters if managers are ever sharded per worker/group bucket
+    __slots__ = ("active_connections", "_ws_to_group")
+
     def __init__(self):
-        # Structure: { "group_id": {websocket_connection1, websocket_connection2} }
-        self.active_connections: Dict[str, Set[WebSocket]] = {}
+        # Structure: { "group_id": GroupState(sockets, usernames, alive) }
+        self.active_connections: Dict[str, GroupState] = {}
+        # Reverse index: which (group, user) a socket belongs to, plus the
+        # user's pre-serialized "left" frame. Makes error-path cleanup O(1)
+        # and lets disconnect announce the departure without reformatting.
+        # Weak keys so a socket that slips past every removal path still
+        # falls out of the index once the GC collects it; the GroupState
+        # lists must keep strong refs for the broadcast loop, and their
+        # stale slots are healed by the writer-error and queue-full drops.
+        self._ws_to_group: "weakref.WeakKeyDictionary[WebSocket, Tuple[str, str, str]]" = weakref.WeakKeyDictionary()
 
     async def connect(self, websocket: WebSocket, group_id: str, user_name: str):
         await websocket.accept()
+        tune_accepted_socket(websocket)
         if group_id not in self.active_connections:
-            self.active_connections[group_id] = set()
-        self.active_connections[group_id].add(websocket)
+            self.active_connections[group_id] = GroupState()
+        # Dedicated bounded queue + writer per connection: broadcast enqueue is
+        # O(1) and a slow peer's TCP backpressure stalls only its own writer
+        queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        task = asyncio.create_task(self._writer(websocket, queue, group_id))
+        self.active_connections[group_id].add(websocket, user_name, queue, task)
+        # Serialize the join/leave system frames once per connection; every
+        # broadcast of them reuses the same string instead of re-encoding
+        join_frame = dumps_payload({"type": "system", "message": f"User '{user_name}' joined the chat."})
+        leave_frame = dumps_payload({"type": "system", "message": f"User '{user_name}' left the chat."})
+        self._ws_to_group[websocket] = (group_id, user_name, leave_frame)
         # Announce user joining (optional, but good for UX)
-        await self.broadcast_to_group(group_id, {"type": "system", "message": f"User '{user_name}' joined the chat."}, exclude_self=None)
-        print(f"User '{user_name}' connected to group '{group_id}'. Connections in group: {len(self.active_connections[group_id])}")
-
-
-    def disconnect(self, websocket: WebSocket, group_id: str, user_name: str):
-        if group_id in self.active_connections:
-            self.active_connections[group_id].remove(websocket)
-            print(f"User '{user_name}' disconnected from group '{group_id}'. Connections in group: {len(self.active_connections[group_id])}")
-            if not self.active_connections[group_id]: # If group is empty, remove it
-                del self.active_connections[group_id]
-                print(f"Group '{group_id}' is now empty and removed.")
-            # Announce user leaving (optional)
-            # Note: We cannot broadcast through the 'websocket' that just disconnected.
-            # So, this broadcast will go to remaining members.
-            # For this to work reliably after disconnect, the broadcast needs to happen
-            # before the actual removal, or triggered by it.
-            # For simplicity, we might skip the "left" message or send it before remove.
-            # Let's try sending it to the remaining members:
-            # await self.broadcast_to_group(group_id, f"User '{user_name}' left the chat.", exclude_self=None) # This needs to be async if used
+        self._broadcast_frame(group_id, join_frame, exclude_self=None)
+        logger.debug("User '%s' connected to group '%s'. Connections in group: %d",
+                     user_name, group_id, self.active_connections[group_id].live_count())
+
+
+    async def _writer(self, websocket: WebSocket, queue: asyncio.Queue, group_id: str):
+        """Drains one connection's outbound queue in its own task."""
+        try:
+            while True:
+                message = await queue.get()
+                await websocket.send(message)
+        except asyncio.CancelledError:
+            raise
+        except (RuntimeError, WebSocketDisconnect) as e:
+            logger.debug("Error sending to a socket: %s. Marking for removal.", e)
+            self._drop(websocket, group_id)
+
+    @staticmethod
+    def _close_slow(websocket: WebSocket):
+        """Terminate a dropped slow consumer so it can reconnect.
+
+        Without the close the client would stay connected as a zombie:
+        still able to send, silently receiving nothing. 1013 (Try Again
+        Later) tells it to back off and re-establish. Fire-and-forget —
+        the broadcast path must not await a misbehaving peer.
+        """
+        asyncio.ensure_future(websocket.close(code=1013))
+
+    def _drop(self, websocket: WebSocket, group_id: str):
+        """Mark a socket dead outside the normal disconnect flow."""
+        self._ws_to_group.pop(websocket, None)
+        group = self.active_connections.get(group_id)
+        if group is not None and group.mark_dead(websocket) is not None:
+            group.compact()
+
+    def _reap(self, group_id: str):
+        """Timer callback: drop the group only if it is still empty."""
+        group = self.active_connections.get(group_id)
+        if group is not None and group.live_count() == 0:
+            del self.active_connections[group_id]
+            logger.debug("Group '%s' is now empty and removed.", group_id)
+
+    def disconnect(self, websocket: WebSocket, group_id: Optional[str] = None, user_name: Optional[str] = None):
+        mapped = self._ws_to_group.pop(websocket, None)
+        if group_id is None:
+            if mapped is None:
+                return  # Never connected, or already cleaned up
+            group_id, user_name = mapped[0], mapped[1]
+        group = self.active_connections.get(group_id)
+        if group is not None:
+            group.mark_dead(websocket)
+            group.compact()
+            logger.debug("User '%s' disconnected from group '%s'. Connections in group: %d",
+                         user_name, group_id, group.live_count())
+            if group.live_count() == 0: # Empty: reap lazily, not immediately
+                asyncio.get_event_loop().call_later(GROUP_REAP_DELAY, self._reap, group_id)
+            elif mapped is not None:
+                # Announce the departure with the frame serialized at connect
+                # time; enqueueing is synchronous, so this works even though
+                # the departing socket itself is already gone
+                self._broadcast_frame(group_id, mapped[2], exclude_self=None)
 
     async def broadcast_to_group(self, group_id: str, message_payload: dict, exclude_self: WebSocket = None):
-        if group_id in self.active_connections:
-            disconnected_sockets = set()
-            for connection in self.active_connections[group_id]:
-                if connection is not exclude_self:
-                    try:
-                        await connection.send_json(message_payload)
-                    except RuntimeError as e: # Handles cases like sending to a closed socket
-                        print(f"Error sending to a socket: {e}. Marking for removal.")
-                        disconnected_sockets.add(connection)
-            
-            # Clean up any sockets that failed during broadcast
-            if disconnected_sockets:
-                self.active_connections[group_id] -= disconnected_sockets
-                print(f"Cleaned up {len(disconnected_sockets)} disconnected sockets from group {group_id}")
-
-
-manager = ConnectionManager()
+        # Kept async for call-site compatibility; enqueueing never blocks.
+        # Serialize once per broadcast — send_json would re-encode the same
+        # payload for every member of the group
+        self._broadcast_frame(group_id, dumps_payload(message_payload), exclude_self)
+
+    def _broadcast_frame(self, group_id: str, data: str, exclude_self: WebSocket = None):
+        """Fan an already-serialized text frame out to a group's queues."""
+        group = self.active_connections.get(group_id)
+        if group is None:
+            return
+        # Singleton groups (fresh rooms, DM-style pairs) are common enough to
+        # deserve a path with no scan and no bookkeeping allocations
+        if len(group.sockets) == 1:
+            ws = group.sockets[0]
+            if group.alive[0] and ws is not exclude_self:
+                if ws.client_state is not _CONNECTED or ws.application_state is not _CONNECTED:
+                    group.mark_dead(ws)
+                    self._ws_to_group.pop(ws, None)
+                    group.compact()
+                    return
+                try:
+                    group.queues[0].put_nowait({"type": "websocket.send", "text": data})
+                except asyncio.QueueFull:
+                    logger.debug("Outbound queue full for a socket in group %s. Marking for removal.", group_id)
+                    self._close_slow(ws)
+                    group.mark_dead(ws)
+                    self._ws_to_group.pop(ws, None)
+                    group.compact()
+            return
+        # One ASGI message dict shared by every recipient, delivered by each
+        # connection's writer task. Enqueueing is O(1) and never awaits, so
+        # broadcast latency is decoupled from the slowest peer entirely; the
+        # whole loop is synchronous, so membership cannot change mid-iteration.
+        message = {"type": "websocket.send", "text": data}
+        alive = group.alive
+        queues = group.queues
+        connected = _CONNECTED
+        disconnected_sockets = []
+        for i, ws in enumerate(group.sockets):
+            if not alive[i] or ws is exclude_self:
+                continue
+            # Cheap state check up front: a socket already closed on either
+            # side gets culled here instead of raising later in its writer —
+            # the writer's try/except stays as the net for genuine races
+            if ws.client_state is not connected or ws.application_state is not connected:
+                disconnected_sockets.append(ws)
+                continue
+            try:
+                queues[i].put_nowait(message)
+            except asyncio.QueueFull:
+                # The peer is OUTBOUND_QUEUE_SIZE messages behind — drop it
+                # rather than stall or buffer without bound
+                logger.debug("Outbound queue full for a socket in group %s. Marking for removal.", group_id)
+                self._close_slow(ws)
+                disconnected_sockets.append(ws)
+
+        if disconnected_sockets:
+            for sock in disconnected_sockets:
+                group.mark_dead(sock)
+                self._ws_to_group.pop(sock, None)
+            group.compact()
+            logger.debug("Cleaned up %d disconnected sockets from group %s",
+                         len(disconnected_sockets), group_id)
+
+
+class ShardedManager:
+    """Partitions groups across independent ConnectionManagers.
+
+    A group lives in exactly one shard (hash(group_id) % N), so every
+    connect/disconnect/broadcast touches only that shard's dicts. With one
+    shared manager, every operation churns the same dict and its cache
+    lines; sharding keeps each bucket small and independent, and lines up
+    with SO_REUSEPORT load balancing if we ever run multi-worker.
+    """
+    __slots__ = ("shards",)
+
+    def __init__(self, num_shards: int = 8):
+        self.shards = [ConnectionManager() for _ in range(num_shards)]
+
+    def _shard(self, group_id: str) -> ConnectionManager:
+        return self.shards[hash(group_id) % len(self.shards)]
+
+    async def connect(self, websocket: WebSocket, group_id: str, user_name: str):
+        await self._shard(group_id).connect(websocket, group_id, user_name)
+
+    def disconnect(self, websocket: WebSocket, group_id: Optional[str] = None, user_name: Optional[str] = None):
+        if group_id is not None:
+            self._shard(group_id).disconnect(websocket, group_id, user_name)
+            return
+        # No group hint (error paths): the owning shard is the one whose
+        # reverse index knows the socket
+        for shard in self.shards:
+            if websocket in shard._ws_to_group:
+                shard.disconnect(websocket)
+                return
+
+    async def broadcast_to_group(self, group_id: str, message_payload: dict, exclude_self: WebSocket = None):
+        await self._shard(group_id).broadcast_to_group(group_id, message_payload, exclude_self)
+
+
+manager = ShardedManager()
 
 @app.websocket("/ws/{group_id}/{user_name}")
 async def websocket_endpoint(websocket: WebSocket, group_id: str, user_name: str):
     await manager.connect(websocket, group_id, user_name)
+    # At most one receive task is in flight at a time. The drain below hands a
+    # not-yet-ready probe back to the blocking await instead of cancelling it,
+    # so no frame can be lost to a cancelled read.
+    receive_task = None
     try:
         while True:
-            data = await websocket.receive_json() # Expecting JSON messages like {"message": "Hello"}
-            print(f"Received from {user_name} in {group_id}: {data}")
-            
-            message_payload = {
-                "type": "chat",
-                "sender": user_name,
-                "groupId": group_id,
-                "message": data.get("message", "") # Get message content
-            }
+            # receive_text + orjson skips Starlette's stdlib-json path; frames
+            # stay text because the browser client JSON.parses event.data
+            if receive_task is None:
+                receive_task = asyncio.ensure_future(websocket.receive_text())
+            raw = await receive_task # Expecting JSON messages like {"message": "Hello"}
+            receive_task = None
+            pending = [loads_payload(raw)]
+            # Drain whatever else this client already has buffered: under load
+            # several frames arrive per event-loop tick, and coalescing them
+            # into one broadcast amortizes the serialize + fan-out cost.
+            # wait(timeout=0) gives the probe exactly one event-loop pass: a
+            # buffered frame completes it, an idle socket leaves it pending
+            # (wait_for(timeout=0) would cancel it before it could run at all).
+            while True:
+                probe = asyncio.ensure_future(websocket.receive_text())
+                done, _ = await asyncio.wait({probe}, timeout=0)
+                if not done:
+                    receive_task = probe  # Becomes the next blocking receive
+                    break
+                if probe.exception() is not None:
+                    # Disconnect mid-burst: broadcast what we have first; the
+                    # next blocking await re-raises it
+                    receive_task = probe
+                    break
+                pending.append(loads_payload(probe.result()))
+            if logger.isEnabledFor(logging.DEBUG):  # Skip even the arg setup per message
+                logger.debug("Received %d frame(s) from %s in %s", len(pending), user_name, group_id)
+
+            if len(pending) > 1:
+                message_payload = {
+                    "type": "chat_batch",
+                    "sender": user_name,
+                    "groupId": group_id,
+                    "messages": [data.get("message", "") for data in pending],
+                }
+            else:
+                message_payload = {
+                    "type": "chat",
+                    "sender": user_name,
+                    "groupId": group_id,
+                    "message": pending[0].get("message", "") # Get message content
+                }
             await manager.broadcast_to_group(group_id, message_payload) # No exclude_self
 
     except WebSocketDisconnect:
+        # disconnect broadcasts the precomputed "left" frame to the rest
         manager.disconnect(websocket, group_id, user_name)
-        # Announce user leaving (if not handled in disconnect method)
-        await manager.broadcast_to_group(group_id, {"type": "system", "message": f"User '{user_name}' left the chat."}, exclude_self=None) # exclude_self=None as the socket is already gone
-        print(f"User '{user_name}' connection closed for group '{group_id}'.")
+        logger.debug("User '%s' connection closed for group '%s'.", user_name, group_id)
     except Exception as e:
-        print(f"Error in websocket_endpoint for {user_name} in {group_id}: {e}")
-        manager.disconnect(websocket, group_id, user_name) # Ensure disconnect on other errors too
+        logger.warning("Error in websocket_endpoint for %s in %s: %s", user_name, group_id, e)
+        manager.disconnect(websocket) # Reverse index resolves the group for us
         # Optionally broadcast a generic error or user left message
+    finally:
+        if receive_task is not None and not receive_task.done():
+            receive_task.cancel()
 
 
 # Optional: A simple HTML page to test WebSocket from browser console
@@ -121,6 +435,8 @@ html_test_page = """
                     var content = JSON.parse(event.data);
                     if (content.type === "system") {
                         message.textContent = `SYSTEM: ${content.message}`;
+                    } else if (content.type === "chat_batch") {
+                        message.textContent = `${content.sender}: ${content.messages.join(" | ")}`;
                     } else {
                         message.textContent = `${content.sender}: ${content.message}`;
                     }
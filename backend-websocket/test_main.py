@@ -1,7 +1,9 @@
 import pytest
 import asyncio # For async operations in tests if needed
+import json
 from main import ConnectionManager # Import your ConnectionManager
 from fastapi import WebSocket # For type hinting and potentially mocking
+from starlette.websockets import WebSocketState
 
 # A simple mock WebSocket class for testing
 class MockWebSocket:
@@ -10,14 +12,30 @@ class MockWebSocket:
         self.sent_data = []
         self.received_data_queue = asyncio.Queue() # For simulating received messages
         self.client_disconnected = False
+        self.close_code = None
+        # Mirror the state attributes broadcast pre-filters on
+        self.client_state = WebSocketState.CONNECTED
+        self.application_state = WebSocketState.CONNECTED
 
     async def accept(self):
         self.accepted = True
 
-    async def send_json(self, data):
+    async def send_text(self, data):
         if self.client_disconnected: # Simulate error if trying to send to a "closed" socket
             raise RuntimeError("WebSocket is closed")
-        self.sent_data.append(data)
+        self.sent_data.append(json.loads(data)) # Store parsed so assertions stay payload-shaped
+
+    async def send(self, message):
+        # Mirrors Starlette's low-level WebSocket.send(ASGI message)
+        if self.client_disconnected:
+            raise RuntimeError("WebSocket is closed")
+        self.sent_data.append(json.loads(message["text"]))
+
+    async def receive_text(self):
+        if self.client_disconnected and self.received_data_queue.empty():
+            from fastapi import WebSocketDisconnect
+            raise WebSocketDisconnect(code=1000)
+        return await self.received_data_queue.get()
 
     async def receive_json(self):
         if self.client_disconnected:
@@ -28,6 +46,8 @@ class MockWebSocket:
 
     async def close(self, code: int = 1000): # Simulate client closing connection
         self.client_disconnected = True
+        self.close_code = code
+        self.client_state = WebSocketState.DISCONNECTED
         # In a real scenario, this might trigger WebSocketDisconnect in the server's read loop
 
     # Helper to simulate client sending data
@@ -40,6 +60,12 @@ def manager():
     """Provides a ConnectionManager instance for each test."""
     return ConnectionManager()
 
+async def drain():
+    """Yield to the event loop until the per-connection writer tasks have
+    delivered everything queued so far."""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
 @pytest.mark.asyncio # Mark test as asynchronous
 async def test_connect_new_group(manager: ConnectionManager):
     ws_alice = MockWebSocket()
@@ -47,10 +73,11 @@ async def test_connect_new_group(manager: ConnectionManager):
     user_name_alice = "Alice"
 
     await manager.connect(ws_alice, group_id, user_name_alice)
+    await drain()
 
     assert ws_alice.accepted
     assert group_id in manager.active_connections
-    assert ws_alice in manager.active_connections[group_id]
+    assert ws_alice in manager.active_connections[group_id].live_sockets()
     # Check if "Alice joined" message was sent (it's the first message)
     assert len(ws_alice.sent_data) == 1
     assert ws_alice.sent_data[0]["type"] == "system"
@@ -69,12 +96,13 @@ async def test_connect_existing_group(manager: ConnectionManager):
     
     # Bob connects to the same group
     await manager.connect(ws_bob, group_id, user_name_bob)
+    await drain()
 
     assert ws_bob.accepted
     assert group_id in manager.active_connections
-    assert len(manager.active_connections[group_id]) == 2
-    assert ws_alice in manager.active_connections[group_id]
-    assert ws_bob in manager.active_connections[group_id]
+    assert manager.active_connections[group_id].live_count() == 2
+    assert ws_alice in manager.active_connections[group_id].live_sockets()
+    assert ws_bob in manager.active_connections[group_id].live_sockets()
 
     # Alice should receive Bob's join message
     # Alice's initial join message + Bob's join message
@@ -95,11 +123,34 @@ async def test_disconnect_one_user(manager: ConnectionManager):
     user_name_alice = "Alice"
 
     await manager.connect(ws_alice, group_id, user_name_alice)
-    assert len(manager.active_connections[group_id]) == 1
+    assert manager.active_connections[group_id].live_count() == 1
 
     manager.disconnect(ws_alice, group_id, user_name_alice) # disconnect is synchronous
 
-    assert group_id not in manager.active_connections # Group should be removed as it's empty
+    # The empty group lingers for GROUP_REAP_DELAY so a reconnect reuses it
+    assert group_id in manager.active_connections
+    assert manager.active_connections[group_id].live_count() == 0
+
+    # A reconnect before the timer fires keeps the group alive through a reap
+    await manager.connect(MockWebSocket(), group_id, "Alice")
+    manager._reap(group_id)
+    assert group_id in manager.active_connections
+
+    manager.disconnect(manager.active_connections[group_id].live_sockets()[0])
+    manager._reap(group_id)
+    assert group_id not in manager.active_connections # Reaped once truly empty
+
+@pytest.mark.asyncio
+async def test_disconnect_without_group_id_uses_reverse_index(manager: ConnectionManager):
+    ws_alice = MockWebSocket()
+    group_id = "test_group_3b"
+
+    await manager.connect(ws_alice, group_id, "Alice")
+    manager.disconnect(ws_alice)  # group resolved via the reverse index
+
+    assert manager.active_connections[group_id].live_count() == 0
+    # A second call (e.g. from an error path) is a harmless no-op
+    manager.disconnect(ws_alice)
 
 @pytest.mark.asyncio
 async def test_disconnect_user_from_group_with_others(manager: ConnectionManager):
@@ -111,14 +162,32 @@ async def test_disconnect_user_from_group_with_others(manager: ConnectionManager
 
     await manager.connect(ws_alice, group_id, user_name_alice)
     await manager.connect(ws_bob, group_id, user_name_bob)
-    assert len(manager.active_connections[group_id]) == 2
+    assert manager.active_connections[group_id].live_count() == 2
 
     manager.disconnect(ws_bob, group_id, user_name_bob) # Bob disconnects
 
     assert group_id in manager.active_connections
-    assert len(manager.active_connections[group_id]) == 1
-    assert ws_alice in manager.active_connections[group_id]
-    assert ws_bob not in manager.active_connections[group_id]
+    assert manager.active_connections[group_id].live_count() == 1
+    assert ws_alice in manager.active_connections[group_id].live_sockets()
+    assert ws_bob not in manager.active_connections[group_id].live_sockets()
+
+@pytest.mark.asyncio
+async def test_disconnect_broadcasts_precomputed_leave_frame(manager: ConnectionManager):
+    ws_alice = MockWebSocket()
+    ws_bob = MockWebSocket()
+    group_id = "test_group_4b"
+
+    await manager.connect(ws_alice, group_id, "Alice")
+    await manager.connect(ws_bob, group_id, "Bob")
+    await drain()
+    ws_alice.sent_data.clear()
+
+    manager.disconnect(ws_bob, group_id, "Bob")
+    await drain()
+
+    # The remaining member hears about the departure via the frame that was
+    # serialized once at Bob's connect time
+    assert ws_alice.sent_data == [{"type": "system", "message": "User 'Bob' left the chat."}]
 
 @pytest.mark.asyncio
 async def test_broadcast_to_group(manager: ConnectionManager):
@@ -134,6 +203,7 @@ async def test_broadcast_to_group(manager: ConnectionManager):
     await manager.connect(ws_alice, group_id_1, user_alice)
     await manager.connect(ws_bob, group_id_1, user_bob) # Bob in the same group as Alice
     await manager.connect(ws_charlie, group_id_2, user_charlie) # Charlie in a different group
+    await drain()
 
     # Clear initial join messages for easier assertion of broadcast message
     ws_alice.sent_data.clear()
@@ -143,6 +213,7 @@ async def test_broadcast_to_group(manager: ConnectionManager):
     message_payload = {"type": "chat", "sender": user_alice, "message": "Hello everyone!"}
     # Alice sends a message, so she should be excluded from receiving it back
     await manager.broadcast_to_group(group_id_1, message_payload, exclude_self=ws_alice)
+    await drain()
 
     # Alice (sender) should not have received her own message via this broadcast
     assert len(ws_alice.sent_data) == 0 
@@ -154,6 +225,61 @@ async def test_broadcast_to_group(manager: ConnectionManager):
     # Charlie (in different group) should not have received the message
     assert len(ws_charlie.sent_data) == 0
 
+@pytest.mark.asyncio
+async def test_sharded_manager_routes_by_group():
+    from main import ShardedManager
+    sharded = ShardedManager(num_shards=4)
+    ws_alice = MockWebSocket()
+    ws_bob = MockWebSocket()
+
+    await sharded.connect(ws_alice, "group_a", "Alice")
+    await sharded.connect(ws_bob, "group_b", "Bob")
+    await drain()
+
+    # Each group lives in exactly one shard
+    assert ws_alice in sharded._shard("group_a").active_connections["group_a"].live_sockets()
+    assert ws_bob in sharded._shard("group_b").active_connections["group_b"].live_sockets()
+
+    await sharded.broadcast_to_group("group_a", {"type": "chat", "message": "hi"})
+    await drain()
+    assert ws_alice.sent_data[-1]["message"] == "hi"
+    assert all(d.get("message") != "hi" for d in ws_bob.sent_data)
+
+    sharded.disconnect(ws_alice)  # Owning shard found via its reverse index
+    assert sharded._shard("group_a").active_connections["group_a"].live_count() == 0
+
+@pytest.mark.asyncio
+async def test_buffered_frames_coalesce_into_chat_batch():
+    from main import manager, websocket_endpoint
+    group_id = "test_group_batch"
+    ws_peer = MockWebSocket()
+    ws_sender = MockWebSocket()
+
+    await manager.connect(ws_peer, group_id, "Peer")
+    await drain()
+    ws_peer.sent_data.clear()
+
+    await ws_sender.simulate_client_send(json.dumps({"message": "one"}))
+    await ws_sender.simulate_client_send(json.dumps({"message": "two"}))
+    # Once the buffer is empty the next receive raises, like a client that
+    # sent a burst and vanished
+    ws_sender.client_disconnected = True
+
+    await websocket_endpoint(ws_sender, group_id, "Sender")
+    await drain()
+
+    # Both buffered frames arrive as one chat_batch broadcast, not two chats
+    batches = [d for d in ws_peer.sent_data if d["type"] == "chat_batch"]
+    assert batches == [{
+        "type": "chat_batch",
+        "sender": "Sender",
+        "groupId": group_id,
+        "messages": ["one", "two"],
+    }]
+    assert all(d["type"] != "chat" for d in ws_peer.sent_data)
+
+    manager.disconnect(ws_peer, group_id, "Peer")
+
 @pytest.mark.asyncio
 async def test_broadcast_to_empty_group_does_not_fail(manager: ConnectionManager):
     message_payload = {"type": "chat", "sender": "System", "message": "Test"}
@@ -171,6 +297,7 @@ async def test_broadcast_with_disconnected_socket_in_group(manager: ConnectionMa
 
     await manager.connect(ws_alice, group_id, user_alice)
     await manager.connect(ws_bob, group_id, user_bob)
+    await drain()
 
     ws_alice.sent_data.clear()
     ws_bob.sent_data.clear()
@@ -180,12 +307,58 @@ async def test_broadcast_with_disconnected_socket_in_group(manager: ConnectionMa
 
     message_payload = {"type": "chat", "sender": "System", "message": "Important update"}
     await manager.broadcast_to_group(group_id, message_payload)
+    await drain()
 
     # Alice should receive the message
     assert len(ws_alice.sent_data) == 1
     assert ws_alice.sent_data[0] == message_payload
 
-    # Bob should not have received it, and his socket should be removed from active connections by the broadcast logic
+    # Bob should not have received it, and his socket should be marked dead by the broadcast logic
     assert len(ws_bob.sent_data) == 0 
-    assert ws_bob not in manager.active_connections.get(group_id, set())
-    assert len(manager.active_connections.get(group_id, set())) == 1 # Only Alice remains
\ No newline at end of file
+    group = manager.active_connections[group_id]
+    assert ws_bob not in group.live_sockets()
+    assert group.live_count() == 1 # Only Alice remains
+
+@pytest.mark.asyncio
+async def test_broadcast_large_group(manager: ConnectionManager):
+    group_id = "test_group_8"
+    sockets = [MockWebSocket() for _ in range(80)]
+    for i, ws in enumerate(sockets):
+        await manager.connect(ws, group_id, f"user{i}")
+    await drain()
+    for ws in sockets:
+        ws.sent_data.clear()
+
+    message_payload = {"type": "chat", "sender": "user0", "message": "Hi all"}
+    await manager.broadcast_to_group(group_id, message_payload, exclude_self=sockets[0])
+    await drain()
+
+    # Sender excluded, every other socket got exactly one copy
+    assert len(sockets[0].sent_data) == 0
+    assert all(ws.sent_data == [message_payload] for ws in sockets[1:])
+
+@pytest.mark.asyncio
+async def test_slow_consumer_dropped_when_queue_fills(manager: ConnectionManager):
+    from main import OUTBOUND_QUEUE_SIZE
+    ws_alice = MockWebSocket()
+    ws_bob = MockWebSocket()
+    group_id = "test_group_9"
+
+    await manager.connect(ws_alice, group_id, "Alice")
+    await manager.connect(ws_bob, group_id, "Bob")
+    await drain()
+
+    # Enqueue without ever yielding, so Bob's writer never gets to run and
+    # his queue overflows — the broadcast path must drop him, not block
+    message_payload = {"type": "chat", "sender": "Alice", "message": "spam"}
+    for _ in range(OUTBOUND_QUEUE_SIZE + 1):
+        await manager.broadcast_to_group(group_id, message_payload, exclude_self=ws_alice)
+
+    group = manager.active_connections[group_id]
+    assert ws_bob not in group.live_sockets()
+    assert ws_alice in group.live_sockets()
+
+    # Bob's connection is actually terminated (1013: Try Again Later), not
+    # left as a zombie that can send but never receives
+    await drain()
+    assert ws_bob.close_code == 1013
@@ -70,9 +70,22 @@ function App() {
       try {
         const receivedMessage = JSON.parse(event.data);
         console.log("Message received:", receivedMessage);
+        // The server coalesces bursts into one "chat_batch" frame; expand it
+        // back into individual chat messages so rendering stays uniform.
+        const newMessages = receivedMessage.type === 'chat_batch'
+          ? receivedMessage.messages.map((message) => ({
+              type: 'chat',
+              sender: receivedMessage.sender,
+              groupId: receivedMessage.groupId,
+              message,
+            }))
+          : [receivedMessage];
         // Add a unique ID to messages on the client-side if backend doesn't provide one
         // This is for React keys. A real backend message ID is better.
-        setMessages((prevMessages) => [...prevMessages, { ...receivedMessage, id: Date.now() + Math.random() }]);
+        setMessages((prevMessages) => [
+          ...prevMessages,
+          ...newMessages.map((m) => ({ ...m, id: Date.now() + Math.random() })),
+        ]);
       } catch (e) {
         console.error("Error parsing message or updating state:", e);
       }